@@ -4,6 +4,7 @@ Based on PureJaxRL Implementation of PPO
 import datetime
 import os
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 import jax
 import jax.numpy as jnp
 import flax.linen as nn
@@ -17,7 +18,7 @@ import jaxmarl
 from typing import Literal, Sequence, NamedTuple, Any
 from dataclasses import asdict, dataclass
 
-from flax import core, struct
+from flax import struct
 from flax.linen.initializers import constant, orthogonal
 from flax.training.train_state import TrainState
 
@@ -37,6 +38,7 @@ class TrainConfig:
     # MEP
     population_size: int = 2
     ent_pop_coeff: float = 0.01
+    parallel_population: bool = False # Train all members at once with pmap, needs population_size devices. total_timesteps is split across members
 
     # Overcooked
     layout_name: Literal["cramped_room", "asymm_advantages", "coord_ring", "forced_coord", "counter_circuit"] = "cramped_room"
@@ -56,6 +58,7 @@ class TrainConfig:
     num_minibatches: int = 4
     gamma: float = 0.99
     gae_lambda: float = 0.95
+    gae_unroll: int = 16 # Unroll factor of the GAE scan, full unrolling compiles far too slowly
     clip_eps: float = 0.2
     ent_coef: float = 0.01
     vf_coef: float = 0.5
@@ -64,6 +67,9 @@ class TrainConfig:
     def __post_init__(self):
         self.num_actors = 2 * self.num_envs
         self.num_updates = int(self.total_timesteps // self.num_steps // self.num_envs)
+        if self.parallel_population:
+            # Every member steps its own envs each update
+            self.num_updates = self.num_updates // self.population_size
         self.minibatch_size = self.num_actors * self.num_steps // self.num_minibatches
 
         print("Number of updates: ", self.num_updates)
@@ -74,49 +80,63 @@ class RolloutStats(struct.PyTreeNode):
     length: jax.Array = jnp.asarray(0)
 
 
-def rollout(rng, layout_name, activation_string, params) -> RolloutStats:
-    def _cond_fn(carry):
-        rng, env_state, stats, obsv, done = carry
-        return (done != True).any() # Continue if not done.
+def make_rollout(env, network):
+    agents = tuple(env.agents)
 
-    def _body_fn(carry):
-        rng, env_state, stats, last_obs, done = carry
+    def rollout(rng, params) -> RolloutStats:
+        def _step_fn(carry, unused):
+            rng, env_state, stats, last_obs, done = carry
 
-        rng, rng_action, rng_step = jax.random.split(rng, 3)
-        obs_batch = batchify(last_obs, env.agents, 2)
-        pi, _ = network.apply(params, obs_batch)
-        action = pi.sample(seed=rng_action).squeeze()
+            rng, rng_action, rng_step = jax.random.split(rng, 3)
+            obs_batch = batchify(last_obs, agents, 2).astype(jnp.float32)
+            pi, _ = network.apply(params, obs_batch)
+            action = pi.sample(seed=rng_action).squeeze()
 
-        env_act = unbatchify(action, env.agents, 1, env.num_agents)
-        env_act = {k: v.flatten().squeeze() for k,v in env_act.items()}
+            env_act = unbatchify(action, agents, 1, len(agents))
+            env_act = {k: v.flatten().squeeze() for k,v in env_act.items()}
 
-        obsv, env_state, reward, done, info = env.step(
-            rng_step, env_state, env_act
-        )
+            obsv, env_state, reward, new_done, info = env.step(
+                rng_step, env_state, env_act
+            )
 
-        stats = stats.replace(
-            reward=stats.reward + reward["agent_0"],
-            length=stats.length + 1
-        )
-        carry = (rng, env_state, stats, obsv, done["__all__"])
-        return carry
-    
-    key, key_r = jax.random.split(rng)
-    env = jaxmarl.make("overcooked", layout=overcooked_layouts[layout_name])
-    network = ActorCritic(env.action_space().n, activation_string)
-    obs, state = env.reset(key_r)
+            # Steps after the episode ended do not count
+            alive = 1 - done
+            stats = stats.replace(
+                reward=stats.reward + reward["agent_0"] * alive,
+                length=stats.length + alive
+            )
+            carry = (rng, env_state, stats, obsv, done | new_done["__all__"])
+            return carry, None
 
-    init_carry = (rng, state, RolloutStats(), obs, jnp.array(False))
+        key, key_r = jax.random.split(rng)
+        obs, state = env.reset(key_r)
 
-    final_carry = jax.lax.while_loop(_cond_fn, _body_fn, init_val=init_carry)
-    return final_carry[2].reward.squeeze(), final_carry[2].length.squeeze()
+        init_carry = (rng, state, RolloutStats(), obs, jnp.array(False))
+
+        # Episodes have a fixed horizon, so a static-length scan covers a full episode
+        final_carry, _ = jax.lax.scan(_step_fn, init_carry, None, env.max_steps)
+        return final_carry[2].reward.squeeze(), final_carry[2].length.squeeze()
+    return rollout
 
 
 class PopulationTrainState(TrainState):
 
-    population: core.FrozenDict[str, Any]
-    other_agent_idcs: jnp.ndarray
-    curr_agent_idx: int
+    population: Any # Params pytree, leaves have a leading population_size axis
+    other_agent_mask: jnp.ndarray # True for every population member except the current agent
+    curr_agent_idx: jnp.ndarray # int32 scalar
+
+
+def rotate_population(train_state: PopulationTrainState, old_idx, new_idx) -> PopulationTrainState:
+    # Write the trained params back into the population and continue with agent new_idx
+    population = jax.tree.map(lambda pop, p: pop.at[old_idx].set(p), train_state.population, train_state.params)
+    new_params = jax.tree.map(lambda x: x[new_idx], population)
+    population_size = train_state.other_agent_mask.shape[0]
+    return train_state.replace(
+        params=new_params,
+        population=population,
+        curr_agent_idx=new_idx,
+        other_agent_mask=jnp.arange(population_size) != new_idx,
+    )
 
 
 class ActorCritic(nn.Module):
@@ -163,7 +183,7 @@ class Transition(NamedTuple):
     value: jnp.ndarray
     reward: jnp.ndarray
     log_prob: jnp.ndarray
-    obs: jnp.ndarray
+    obs: jnp.ndarray # uint8, Overcooked observation layers are small counts (at most 19, the cooking timer)
     info: jnp.ndarray
     neg_logp_pop_new: jnp.ndarray
     orig_reward: jnp.ndarray
@@ -173,12 +193,12 @@ class Transition(NamedTuple):
 
 
 MAX_ENT = -jnp.log(1/6)
-def entropy(action_probs):
-    # assert action_probs.shape[1] == 6, 'action_probs.shape[1] == 6'
-    neg_p_logp = - action_probs * jnp.log(action_probs)
-    entropy = jnp.sum(neg_p_logp, axis=1)
+def pop_stats(log_p, actions):
+    # Entropy and -log p(action) from the same log-probabilities
+    entropy = -jnp.sum(jnp.exp(log_p) * log_p, axis=-1)
     # assert jnp.max(entropy) <= MAX_ENT+1e5, 'entropy_max <= MAX_ENT'
-    return entropy
+    neg_logp = -jnp.take_along_axis(log_p, actions[:, None], axis=1).squeeze(-1)
+    return entropy, neg_logp
 
 
 def batchify(x: dict, agent_list, num_actors):
@@ -192,22 +212,39 @@ def unbatchify(x: jnp.ndarray, agent_list, num_envs, num_actors):
 
 
 def make_update_fn(config, env, network):
+    # Looked up once here rather than on every trace of _env_step
+    agents = tuple(env.agents)
+    num_agents = len(agents)
+    num_actors = config.num_actors
+
     rew_shaping_anneal = optax.linear_schedule(
         init_value=1.,
         end_value=0.,
         transition_steps=config.rew_shaping_horizon
     )
 
+    def batchify_stack(x: dict):
+        # (num_agents, num_envs, ...) -> (num_actors, -1) in a single stack
+        return jnp.stack([x[a] for a in agents]).reshape((num_actors, -1))
+
+    def unbatchify_act(x: jnp.ndarray):
+        # env.step wants a dict of flat per-agent actions, build it once here
+        x = x.reshape((num_agents, config.num_envs))
+        return {a: x[i] for i, a in enumerate(agents)}
+
         # TRAIN LOOP
     def _update_step(runner_state):
         # COLLECT TRAJECTORIES
-        def _env_step(runner_state, unused):
+        def _env_step(runner_state, step_key):
             train_state, env_state, last_obs, update_step, rng = runner_state
-            # SELECT ACTION
-            rng, _rng = jax.random.split(rng)
+            # One split per step: a key for the action, one per env for the step
+            step_keys = jax.random.split(step_key, 1 + config.num_envs)
+            _rng, rng_step = step_keys[0], step_keys[1:]
 
-            obs_batch = jnp.stack([last_obs[a] for a in env.agents]).reshape(-1, *env.observation_space().shape)
-            obs_batch = obs_batch.reshape(config.num_actors, -1)
+            # SELECT ACTION
+            # Keep the stored trajectory obs in uint8 and only upcast for the network
+            obs_u8 = batchify_stack(last_obs).astype(jnp.uint8)
+            obs_batch = obs_u8.astype(jnp.float32)
 
             pi, value = network.apply(train_state.params, obs_batch)
             action = pi.sample(seed=_rng)
@@ -215,90 +252,82 @@ def make_update_fn(config, env, network):
 
             # --------------------- #
             # NOTE: THIS IS FOR MEP #
-            action_probs_agent0 = pi.probs
-            actions = action
+            log_p_agent0 = jax.nn.log_softmax(pi.logits)
+            actions = action.astype(jnp.int32)
             # --------------------- #
 
-            action_probs_np = jnp.zeros((config.population_size, config.num_actors, 6)) ## 6 is the action_dim
-            actions_np = jnp.zeros((config.population_size, config.num_actors)) # Is 128 the batch size? The number of parallel envs?
-
-            for i in range(config.population_size):
-                rng, _rng = jax.random.split(rng)
-                pi, value = network.apply(train_state.population[i], obs_batch)
-                action = pi.sample(seed=_rng)
-                log_prob = pi.log_prob(action)
-                actions_np = actions_np.at[i].set(action)
-                action_probs_np = action_probs_np.at[i].set(pi.probs)
-
-            # Remove current agent
-            action_probs_np = jnp.delete(action_probs_np, train_state.curr_agent_idx, axis=0, assume_unique_indices=True)
-            actions_np = jnp.delete(actions_np, train_state.curr_agent_idx, axis=0, assume_unique_indices=True)
-            
-            action_probs_pop_np = jnp.mean(action_probs_np, axis=0)
-
-            action_probs_np_new = jnp.append(action_probs_np, jnp.expand_dims(action_probs_agent0, axis=0), axis=0)
-
-            action_probs_pop_np_new = jnp.mean(action_probs_np_new, axis=0)
-            entropy_pop = entropy(action_probs_pop_np)
-            entropy_pop_new = entropy(action_probs_pop_np_new)
+            # Population params are stacked along a leading axis, so all members run in one call.
+            # Only their log-probabilities are needed: MEP scores the current agent's action under them.
+            pop_pi, _ = jax.vmap(network.apply, in_axes=(0, None))(train_state.population, obs_batch)
+            log_p_stack = jax.nn.log_softmax(pop_pi.logits) # (population_size, num_actors, action_dim)
+
+            # log of the population mean probs, the current agent is masked out with -inf
+            log_p_stack = jnp.where(train_state.other_agent_mask[:, None, None], log_p_stack, -jnp.inf)
+            log_p_pop = jax.nn.logsumexp(log_p_stack, axis=0) - jnp.log(config.population_size - 1)
+
+            # Population mean with the current agent's policy put back in
+            log_p_pop_new = jnp.logaddexp(
+                log_p_pop + jnp.log(config.population_size - 1), log_p_agent0
+            ) - jnp.log(config.population_size)
+            entropy_pop, neg_logp_pop = pop_stats(log_p_pop, actions)
+            entropy_pop_new, neg_logp_pop_new = pop_stats(log_p_pop_new, actions)
             entropy_pop_delta = entropy_pop_new - entropy_pop
-
-            sampled_action_prob_pop_np = jnp.take(action_probs_pop_np, actions)
-            neg_logp_pop = - jnp.log(sampled_action_prob_pop_np)
-            sampled_action_prob_pop_np_new = jnp.take(action_probs_pop_np_new, actions)
-            neg_logp_pop_new = - jnp.log(sampled_action_prob_pop_np_new)
             neg_logp_pop_delta = neg_logp_pop_new - neg_logp_pop
 
 
-            env_act = unbatchify(
-                action, env.agents, config.num_envs, env.num_agents
-            )
-
-            env_act = {k: v.flatten() for k, v in env_act.items()}
+            env_act = unbatchify_act(action)
 
             # STEP ENV
-            rng, _rng = jax.random.split(rng)
-            rng_step = jax.random.split(_rng, config.num_envs)
-
             # ipdb.set_trace()
             obsv, env_state, orig_reward, done, info = jax.vmap(
                 env.step, in_axes=(0, 0, 0)
             )(rng_step, env_state, env_act)
 
             shaped_reward = info.pop("shaped_reward")
-            current_timestep = update_step*config.num_steps*config.num_envs
-            reward = jax.tree.map(lambda x,y: x+y*rew_shaping_anneal(current_timestep), orig_reward, shaped_reward)
-            neg_logp_pop_new_a = neg_logp_pop_new.reshape((2, config.num_envs))
-            neg_logp_pop_new_a = {"agent_0": neg_logp_pop_new[0], "agent_1": neg_logp_pop_new[1]}
-            reward = jax.tree.map(lambda x,y: x+y*config.ent_pop_coeff, reward, neg_logp_pop_new_a)
+            # Rewards as (num_agents, num_envs) arrays, same actor order as obs_batch
+            orig_reward = jnp.stack([orig_reward[a] for a in agents])
+            shaped_reward = jnp.stack([shaped_reward[a] for a in agents])
+            reward = (
+                orig_reward
+                + shaped_reward * anneal_coef
+                + neg_logp_pop_new.reshape((num_agents, config.num_envs)) * config.ent_pop_coeff
+            )
 
-            info = jax.tree.map(lambda x: x.reshape((config.num_actors)), info)
+            info = jax.tree.map(lambda x: x.reshape((num_actors)), info)
 
             transition = Transition(
-                batchify(done, env.agents, config.num_actors).squeeze(),
+                batchify_stack(done).squeeze(),
                 action,
                 value,
-                batchify(reward, env.agents, config.num_actors).squeeze(),
+                reward.reshape(num_actors),
                 log_prob,
-                obs_batch,
+                obs_u8,
                 info,
                 neg_logp_pop_new,
-                batchify(orig_reward, env.agents, config.num_actors).squeeze(),
-                batchify(shaped_reward, env.agents, config.num_actors).squeeze(),
+                orig_reward.reshape(num_actors),
+                shaped_reward.reshape(num_actors),
                 entropy_pop_delta,
                 neg_logp_pop_delta,
             )
             runner_state = (train_state, env_state, obsv, update_step, rng)
             return runner_state, transition
 
+        train_state, env_state, last_obs, update_step, rng = runner_state
+        if config.parallel_population:
+            # Each device trains one member, assemble the population from all of them
+            train_state = train_state.replace(population=jax.lax.all_gather(train_state.params, axis_name="pop"))
+        rng, _rng = jax.random.split(rng)
+        step_keys = jax.random.split(_rng, config.num_steps)
+        # update_step is fixed during the rollout, so the shaping coefficient is too
+        anneal_coef = rew_shaping_anneal(update_step * config.num_steps * config.num_envs)
+        runner_state = (train_state, env_state, last_obs, update_step, rng)
         runner_state, traj_batch = jax.lax.scan(
-            _env_step, runner_state, None, config.num_steps
+            _env_step, runner_state, step_keys
         )
 
         # CALCULATE ADVANTAGE
         train_state, env_state, last_obs, update_step, rng = runner_state
-        last_obs_batch = jnp.stack([last_obs[a] for a in env.agents]).reshape(-1, *env.observation_space().shape)
-        last_obs_batch = last_obs_batch.reshape(config.num_actors, -1)
+        last_obs_batch = batchify_stack(last_obs).astype(jnp.float32)
 
         _, last_val = network.apply(train_state.params, last_obs_batch)
 
@@ -322,97 +351,93 @@ def make_update_fn(config, env, network):
                 (jnp.zeros_like(last_val), last_val),
                 traj_batch,
                 reverse=True,
-                unroll=16,
+                unroll=min(config.gae_unroll, config.num_steps),
             )
             return advantages, advantages + traj_batch.value
 
         advantages, targets = _calculate_gae(traj_batch, last_val)
+        # Normalise once over the whole batch instead of in every minibatch loss
+        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
 
         # UPDATE NETWORK
-        def _update_epoch(update_state, unused):
-            def _update_minbatch(train_state, batch_info):
-                traj_batch, advantages, targets = batch_info
-
-                def _loss_fn(params, traj_batch, gae, targets):
-                    # RERUN NETWORK
-                    pi, value = network.apply(params, traj_batch.obs)
-                    log_prob = pi.log_prob(traj_batch.action)
-
-                    # CALCULATE VALUE LOSS
-                    value_pred_clipped = traj_batch.value + (
-                        value - traj_batch.value
-                    ).clip(-config.clip_eps, config.clip_eps)
-                    value_losses = jnp.square(value - targets)
-                    value_losses_clipped = jnp.square(value_pred_clipped - targets)
-                    value_loss = (
-                        0.5 * jnp.maximum(value_losses, value_losses_clipped).mean()
-                    )
+        def _update_minbatch(train_state, batch_info):
+            # Gather this minibatch straight from the unshuffled batch
+            traj_batch, advantages, targets = jax.tree_util.tree_map(
+                lambda x: jnp.take(x, batch_info, axis=0), batch
+            )
 
-                    # CALCULATE ACTOR LOSS
-                    ratio = jnp.exp(log_prob - traj_batch.log_prob)
-                    gae = (gae - gae.mean()) / (gae.std() + 1e-8)
-                    loss_actor1 = ratio * gae
-                    loss_actor2 = (
-                        jnp.clip(
-                            ratio,
-                            1.0 - config.clip_eps,
-                            1.0 + config.clip_eps,
-                        )
-                        * gae
-                    )
-                    loss_actor = -jnp.minimum(loss_actor1, loss_actor2)
-                    loss_actor = loss_actor.mean()
-                    entropy = pi.entropy().mean()
-
-                    total_loss = (
-                        loss_actor
-                        + config.vf_coef * value_loss
-                        - config.ent_coef * entropy
-                    )
-                    return total_loss, (value_loss, loss_actor, entropy)
+            def _loss_fn(params, traj_batch, gae, targets):
+                # RERUN NETWORK
+                pi, value = network.apply(params, traj_batch.obs.astype(jnp.float32))
+                log_prob = pi.log_prob(traj_batch.action)
+
+                # CALCULATE VALUE LOSS
+                value_pred_clipped = traj_batch.value + (
+                    value - traj_batch.value
+                ).clip(-config.clip_eps, config.clip_eps)
+                value_losses = jnp.square(value - targets)
+                value_losses_clipped = jnp.square(value_pred_clipped - targets)
+                value_loss = (
+                    0.5 * jnp.maximum(value_losses, value_losses_clipped).mean()
+                )
 
-                grad_fn = jax.value_and_grad(_loss_fn, has_aux=True)
-                total_loss, grads = grad_fn(
-                    train_state.params, traj_batch, advantages, targets
+                # CALCULATE ACTOR LOSS
+                ratio = jnp.exp(log_prob - traj_batch.log_prob)
+                loss_actor1 = ratio * gae
+                loss_actor2 = (
+                    jnp.clip(
+                        ratio,
+                        1.0 - config.clip_eps,
+                        1.0 + config.clip_eps,
+                    )
+                    * gae
                 )
-                train_state = train_state.apply_gradients(grads=grads)
-                return train_state, total_loss
-
-            train_state, traj_batch, advantages, targets, rng = update_state
-            rng, _rng = jax.random.split(rng)
-            batch_size = config.minibatch_size * config.num_minibatches
-            assert (
-                batch_size == config.num_steps * config.num_actors
-            ), "batch size must be equal to number of steps * number of actors"
-            permutation = jax.random.permutation(_rng, batch_size)
-            batch = (traj_batch, advantages, targets)
-            batch = jax.tree_util.tree_map(
-                lambda x: x.reshape((batch_size,) + x.shape[2:]), batch
-            )
-            shuffled_batch = jax.tree_util.tree_map(
-                lambda x: jnp.take(x, permutation, axis=0), batch
-            )
-            minibatches = jax.tree_util.tree_map(
-                lambda x: jnp.reshape(
-                    x, [config.num_minibatches, -1] + list(x.shape[1:])
-                ),
-                shuffled_batch,
-            )
-            train_state, total_loss = jax.lax.scan(
-                _update_minbatch, train_state, minibatches
-            )
-            update_state = (train_state, traj_batch, advantages, targets, rng)
-            return update_state, total_loss
+                loss_actor = -jnp.minimum(loss_actor1, loss_actor2)
+                loss_actor = loss_actor.mean()
+                entropy = pi.entropy().mean()
+
+                total_loss = (
+                    loss_actor
+                    + config.vf_coef * value_loss
+                    - config.ent_coef * entropy
+                )
+                return total_loss, (value_loss, loss_actor, entropy)
 
-        update_state = (train_state, traj_batch, advantages, targets, rng)
-        update_state, loss_info = jax.lax.scan(
-            _update_epoch, update_state, None, config.update_epochs
+            grad_fn = jax.value_and_grad(_loss_fn, has_aux=True)
+            total_loss, grads = grad_fn(
+                train_state.params, traj_batch, advantages, targets
+            )
+            train_state = train_state.apply_gradients(grads=grads)
+            return train_state, total_loss
+
+        rng, _rng = jax.random.split(rng)
+        batch_size = config.minibatch_size * config.num_minibatches
+        assert (
+            batch_size == config.num_steps * num_actors
+        ), "batch size must be equal to number of steps * number of actors"
+        batch = (traj_batch, advantages, targets)
+        batch = jax.tree_util.tree_map(
+            lambda x: x.reshape((batch_size,) + x.shape[2:]), batch
+        )
+        # One permutation per epoch, all epochs' minibatches run in a single scan
+        permutations = jax.vmap(lambda k: jax.random.permutation(k, batch_size))(
+            jax.random.split(_rng, config.update_epochs)
+        )
+        minibatch_idcs = permutations.reshape(
+            (config.update_epochs * config.num_minibatches, config.minibatch_size)
+        )
+        train_state, loss_info = jax.lax.scan(
+            _update_minbatch, train_state, minibatch_idcs
         )
-        train_state = update_state[0]
         metric = traj_batch.info
-        rng = update_state[-1]
 
-        def callback(metric):
+        def callback(metric, member):
+            if config.parallel_population:
+                # Every device logs its own member, keep their curves apart
+                metric = {
+                    k if k in ("update_step", "env_step") else f"member_{int(member)}/{k}": v
+                    for k, v in metric.items()
+                }
             wandb.log(metric)
 
         update_step = update_step + 1
@@ -424,7 +449,7 @@ def make_update_fn(config, env, network):
         metric["neg_logp_pop_delta"] = jnp.mean(traj_batch.neg_logp_pop_delta)
         metric["orig_reward"] = traj_batch.orig_reward.sum(axis=0).mean() / 2
         metric["shaped_reward"] = traj_batch.shaped_reward.sum(axis=0).mean()
-        jax.debug.callback(callback, metric)
+        jax.debug.callback(callback, metric, train_state.curr_agent_idx)
 
         runner_state = (train_state, env_state, last_obs, update_step, rng)
         return runner_state, metric
@@ -478,11 +503,10 @@ def train(config: TrainConfig):
     init_x = jnp.zeros(env.observation_space().shape)
     init_x = init_x.flatten()
 
-    # network parameter dictionary
-    a_jnp_dict = {}
-    for i in range(config.population_size):
-        rng, _rng_a = jax.random.split(rng, 2)
-        a_jnp_dict[i] = network.init(_rng_a, init_x) 
+    # Population params as a single pytree indexed by its leading axis
+    rng, _rng_a = jax.random.split(rng, 2)
+    init_rngs = jax.random.split(_rng_a, config.population_size)
+    population = jax.vmap(network.init, in_axes=(0, None))(init_rngs, init_x)
 
 
     if config.anneal_lr:
@@ -496,72 +520,139 @@ def train(config: TrainConfig):
     key = jax.random.PRNGKey(0)
     all_agent_idcs = jnp.arange(config.population_size)
     param_idx = int(jax.random.choice(key, all_agent_idcs))
-    other_agent_idcs = all_agent_idcs[all_agent_idcs != param_idx]
-    params_ts = a_jnp_dict[param_idx]
-
-    train_state = PopulationTrainState.create(
-        apply_fn=network.apply,
-        params=params_ts,
-        tx=tx,
-        population=a_jnp_dict,
-        other_agent_idcs=other_agent_idcs,
-        curr_agent_idx=param_idx,
-    )
+    other_agent_mask = all_agent_idcs != param_idx
+    params_ts = jax.tree.map(lambda x: x[param_idx], population)
+
+    if config.parallel_population:
+        assert (
+            jax.device_count() >= config.population_size
+        ), "parallel_population needs one device per population member"
+        # One train state per member, stacked along the device axis
+        train_state = jax.vmap(
+            lambda params, idx: PopulationTrainState.create(
+                apply_fn=network.apply,
+                params=params,
+                tx=tx,
+                population=population,
+                other_agent_mask=all_agent_idcs != idx,
+                curr_agent_idx=idx,
+            )
+        )(population, all_agent_idcs)
+    else:
+        train_state = PopulationTrainState.create(
+            apply_fn=network.apply,
+            params=params_ts,
+            tx=tx,
+            population=population,
+            other_agent_mask=other_agent_mask,
+            # A strong int32 like the one rotate_population writes back, a weak Python int would recompile the second chunk
+            curr_agent_idx=jnp.int32(param_idx),
+        )
 
     # INIT UPDATE FUNCTION
     _update_step = make_update_fn(config, env, network)
-    jitted_update_step = jax.jit(_update_step)
 
-    # INIT EVAL ROLLOUT FUNCTION
-    jitted_rollout = jax.jit(rollout, static_argnums=(1,2)) # config is static
-    
-    # INIT ENV
-    rng, _rng = jax.random.split(rng)
-    reset_rng = jax.random.split(_rng, config.num_envs)
-    obsv, env_state = jax.vmap(env.reset, in_axes=(0,))(reset_rng)
-    
-    runner_state = (train_state, env_state, obsv, 0, _rng)
+    def _update_and_rotate(runner_state, rotation_key):
+        runner_state, metric = _update_step(runner_state)
+        train_state = runner_state[0]
 
-    now = '{:%Y-%m-%d_%H:%M:%S}'.format(datetime.datetime.now())
+        # Now we need to update the population with the newly trained agent
+        new_param_idx = jax.random.choice(rotation_key, all_agent_idcs)
+        train_state = rotate_population(train_state, train_state.curr_agent_idx, new_param_idx)
+        runner_state = (train_state, ) + runner_state[1:]
+        return runner_state, metric
 
-    old_param_idx = param_idx    
-    for i in range(config.num_updates):
-        key, _key = jax.random.split(key)
+    def _update_chunk(runner_state, rotation_keys):
+        # Run one update per rotation key without returning to Python in between
+        return jax.lax.scan(_update_and_rotate, runner_state, rotation_keys)
 
-        runner_state, metric = jitted_update_step(runner_state)
-        train_state = runner_state[0]
+    def _update_chunk_parallel(runner_state, chunk_length):
+        # Every member trains on its own device, so there is nothing to rotate
+        return jax.lax.scan(lambda carry, unused: _update_step(carry), runner_state, None, chunk_length)
 
-        # Now we need to update the population with the newly trained agent
-        new_param_idx = int(jax.random.choice(_key, all_agent_idcs))
-        population = train_state.population
-        new_params_to_train = population[new_param_idx]
-        population[old_param_idx] = train_state.params # Update the newly trained agent in population with the new parameters
-        train_state = train_state.replace(
-            population=population,
-            params=new_params_to_train,
-            curr_agent_idx=new_param_idx,
-            other_agent_idcs=all_agent_idcs[all_agent_idcs != new_param_idx]
+    # runner_state goes in and comes out with identical shapes, let XLA reuse its buffers
+    if config.parallel_population:
+        jitted_update_chunk = jax.pmap(
+            _update_chunk_parallel, axis_name="pop", static_broadcasted_argnums=(1,), donate_argnums=(0,)
         )
-        
-        runner_state = (train_state, ) + runner_state[1:]
-        old_param_idx = new_param_idx
+    else:
+        jitted_update_chunk = jax.jit(_update_chunk, donate_argnums=(0,))
 
+    # INIT EVAL ROLLOUT FUNCTION
+    # Evaluates every population member in one launch, on an env without the LogWrapper
+    eval_env = jaxmarl.make("overcooked", layout=overcooked_layouts[config.layout_name])
+    rollout = make_rollout(eval_env, network)
+    jitted_rollout = jax.jit(jax.vmap(rollout, in_axes=(0, 0)))
+    
+    # INIT ENV
+    rng, _rng = jax.random.split(rng)
+    if config.parallel_population:
+        # Separate parents, split(k, P)[i] == split(k, P * num_envs)[i] would share keys between the two
+        _rng_reset, _rng_runner = jax.random.split(_rng)
+        reset_rng = jax.random.split(_rng_reset, config.population_size * config.num_envs)
+        reset_rng = reset_rng.reshape((config.population_size, config.num_envs) + reset_rng.shape[1:])
+        obsv, env_state = jax.vmap(jax.vmap(env.reset, in_axes=(0,)))(reset_rng)
+        update_steps = jnp.zeros(config.population_size, dtype=jnp.int32)
+        runner_state = (train_state, env_state, obsv, update_steps, jax.random.split(_rng_runner, config.population_size))
+    else:
+        reset_rng = jax.random.split(_rng, config.num_envs)
+        obsv, env_state = jax.vmap(env.reset, in_axes=(0,))(reset_rng)
+        runner_state = (train_state, env_state, obsv, 0, _rng)
 
-        # Remarkably, saving is among the most expensive operations
-        if i % config.checkpoint_freq == 0 and i != 0:
-            print(i)
-            for p in range(config.population_size):
-                params = train_state.population[p]
-                total_r, total_l = jitted_rollout(rng, config.layout_name, config.activation, params)
-                print(total_l)
+    now = '{:%Y-%m-%d_%H:%M:%S}'.format(datetime.datetime.now())
 
-                path = f"{save_dir}/{config.layout_name}/{now}/{p}" 
-                os.makedirs(path, exist_ok=True)
-                payload = (None, {"actor_params": params})
-                pickle.dump(payload, open(path + f"/params_{i}_{total_r}.pt", "wb"))
-                print("Saved params for agent", p, "with total reward", total_r)
+    # Checkpoints are written on a background thread so the next update chunk can be dispatched right away
+    executor = ThreadPoolExecutor(max_workers=1)
+    save_futures = []
+
+    def _save_fn(i, p, params, total_r, total_l):
+        # Waiting on the device happens here, off the main thread
+        params, total_r, total_l = jax.device_get((params, total_r, total_l))
+        print(total_l)
+
+        path = f"{save_dir}/{config.layout_name}/{now}/{p}" 
+        os.makedirs(path, exist_ok=True)
+        payload = (None, {"actor_params": params})
+        with open(path + f"/params_{i}_{total_r}.pt", "wb") as f:
+            pickle.dump(payload, f)
+        print("Saved params for agent", p, "with total reward", total_r)
+
+    # Updates are grouped into chunks of checkpoint_freq, we only come back to Python to save.
+    # A shorter final chunk compiles its own scan once.
+    num_chunks, remainder = divmod(config.num_updates, config.checkpoint_freq)
+    chunk_lengths = [config.checkpoint_freq] * num_chunks + ([remainder] if remainder else [])
+    i = 0
+    try:
+        for chunk_length in chunk_lengths:
+            if config.parallel_population:
+                runner_state, metric = jitted_update_chunk(runner_state, chunk_length)
+                population = runner_state[0].params # Stacked along the device axis
+            else:
+                key, _key = jax.random.split(key)
+                rotation_keys = jax.random.split(_key, chunk_length)
+                runner_state, metric = jitted_update_chunk(runner_state, rotation_keys)
+                population = runner_state[0].population
+            i += chunk_length
+
+            # Remarkably, saving is among the most expensive operations
+            print(i)
+            # Wait for the previous checkpoint: a failed save stops the run here and at most one chunk is pending
+            for future in save_futures:
+                future.result()
+            save_futures = []
 
- 
+            rollout_rngs = jax.random.split(rng, config.population_size)
+            total_rs, total_ls = jitted_rollout(rollout_rngs, population)
+            for p in range(config.population_size):
+                # Slicing copies the params, so donating runner_state in the next chunk does not free them
+                params = jax.tree.map(lambda x: x[p], population)
+                save_futures.append(executor.submit(_save_fn, i, p, params, total_rs[p], total_ls[p]))
+
+        # Drain the last checkpoint and surface any error raised while saving
+        for future in save_futures:
+            future.result()
+    finally:
+        executor.shutdown(wait=True)
 
     return {"runner_state": runner_state, "metrics": metric}
 